@@ -2,51 +2,260 @@
 """
 CDK Custom Resource Lambda to apply Kubernetes manifests.
 This is triggered during cdk deploy to automatically apply manifests.
+
+Manifests are applied in-process with the Kubernetes Python client using
+server-side apply, so no kubectl binary or kubeconfig is needed.
 """
 
 import json
-import boto3
-import subprocess
+import base64
+import time
+import tarfile
 import tempfile
 import os
-from urllib.request import Request, urlopen
-
-s3 = boto3.client('s3')
-eks = boto3.client('eks')
-
-def get_kubeconfig(cluster_name, region):
-    """Generate kubeconfig for EKS cluster."""
-    cluster_info = eks.describe_cluster(name=cluster_name)
-    cluster = cluster_info['cluster']
-    
-    kubeconfig = f"""apiVersion: v1
-kind: Config
-clusters:
-- name: {cluster_name}
-  cluster:
-    server: {cluster['endpoint']}
-    certificate-authority-data: {cluster['certificateAuthority']['data']}
-contexts:
-- name: {cluster_name}
-  context:
-    cluster: {cluster_name}
-    user: {cluster_name}
-current-context: {cluster_name}
-users:
-- name: {cluster_name}
-  user:
-    exec:
-      apiVersion: client.authentication.k8s.io/v1beta1
-      command: aws
-      args:
-        - eks
-        - get-token
-        - --cluster-name
-        - {cluster_name}
-        - --region
-        - {region}
-"""
-    return kubeconfig
+import urllib3
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3 and the Kubernetes client are imported on first use rather than at
+# module load, so Delete requests (which only answer CloudFormation) skip
+# their import and client set-up cost
+
+# Prefer the libyaml-backed loader, which parses several times faster
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# orjson encodes several times faster than json and returns bytes directly;
+# fall back when it isn't bundled
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def to_json_bytes(obj):
+    """Serialize obj to UTF-8 encoded JSON."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+# Concurrency for listing sub-prefixes and fetching manifests from S3
+LIST_WORKERS = 16
+DOWNLOAD_WORKERS = 16
+
+# S3 can't filter by suffix, so keys are matched client-side; ask for full pages
+MANIFEST_SUFFIXES = ('.yaml', '.yml')
+LIST_PAGE_SIZE = 1000
+
+# Optional single-object bundle of every manifest under the prefix, which
+# replaces one LIST plus a GET per file with a single GET
+MANIFEST_BUNDLE = 'manifests.tar.gz'
+
+FIELD_MANAGER = 'k8s-applier'
+
+_SESSION = None
+_AWS_CLIENTS = {}
+
+# Reused for the CloudFormation response so warm invocations skip the TLS
+# handshake; bounded so a hung ResponseURL can't hold the function until it times out
+_HTTP = urllib3.PoolManager(num_pools=2, maxsize=4, timeout=urllib3.Timeout(connect=5, read=30))
+
+# Cached across warm invocations, by cluster name and region: the endpoint
+# and CA of a cluster never change, and EKS tokens stay valid for 15 minutes
+# so refresh well before that
+TOKEN_TTL_SECONDS = 600
+_CLUSTER_CACHE = {}
+_TOKEN_CACHE = {}
+_CA_CERT_PATHS = {}
+
+def get_session():
+    """Return the boto3 session, importing boto3 on first use."""
+    global _SESSION
+    if _SESSION is None:
+        import boto3
+        _SESSION = boto3.session.Session()
+    return _SESSION
+
+def get_aws_client(service, region_name=None):
+    """Return a cached boto3 client for a service, optionally in a given region."""
+    key = (service, region_name)
+    if key not in _AWS_CLIENTS:
+        from botocore.config import Config
+        # Size the S3 connection pool for every list and download worker, so
+        # threads don't queue waiting for a connection
+        config = Config(max_pool_connections=LIST_WORKERS + DOWNLOAD_WORKERS) if service == 's3' else None
+        _AWS_CLIENTS[key] = get_session().client(service, region_name=region_name, config=config)
+    return _AWS_CLIENTS[key]
+
+def get_cluster(cluster_name, region):
+    """Describe an EKS cluster, once per Lambda container."""
+    key = (cluster_name, region)
+    if key not in _CLUSTER_CACHE:
+        eks = get_aws_client('eks', region)
+        _CLUSTER_CACHE[key] = eks.describe_cluster(name=cluster_name)['cluster']
+    return _CLUSTER_CACHE[key]
+
+def get_bearer_token(cluster_name, region):
+    """Get EKS authentication token, reusing it while still fresh.
+    
+    Builds the same token as 'aws eks get-token': a presigned STS
+    GetCallerIdentity URL bound to the cluster by the x-k8s-aws-id header.
+    """
+    token, fetched_at = _TOKEN_CACHE.get((cluster_name, region), (None, 0))
+    if token and time.monotonic() - fetched_at < TOKEN_TTL_SECONDS:
+        return token
+    
+    from botocore.signers import RequestSigner
+    
+    session = get_session()
+    # The token must be signed for, and point at, the STS endpoint of the
+    # cluster's region, whatever partition it is in
+    sts = get_aws_client('sts', region)
+    signer = RequestSigner(
+        sts.meta.service_model.service_id,
+        region,
+        'sts',
+        'v4',
+        session.get_credentials(),
+        session.events
+    )
+    url = signer.generate_presigned_url(
+        {
+            'method': 'GET',
+            'url': f"{sts.meta.endpoint_url.rstrip('/')}/?Action=GetCallerIdentity&Version=2011-06-15",
+            'body': {},
+            'headers': {'x-k8s-aws-id': cluster_name},
+            'context': {}
+        },
+        region_name=region,
+        expires_in=60,
+        operation_name=''
+    )
+    token = 'k8s-aws-v1.' + base64.urlsafe_b64encode(url.encode('utf-8')).decode('utf-8').rstrip('=')
+    _TOKEN_CACHE[(cluster_name, region)] = (token, time.monotonic())
+    return token
+
+def write_ca_cert(cluster_name, region, ca_data):
+    """Write a cluster's CA certificate to /tmp, once per Lambda container."""
+    key = (cluster_name, region)
+    if key not in _CA_CERT_PATHS:
+        path = os.path.join(tempfile.gettempdir(), f'{cluster_name}-{region}-ca.crt')
+        with open(path, 'wb') as f:
+            f.write(base64.b64decode(ca_data))
+        _CA_CERT_PATHS[key] = path
+    return _CA_CERT_PATHS[key]
+
+def get_k8s_client(cluster_name, region):
+    """Create Kubernetes client configured for EKS cluster."""
+    from kubernetes import client
+    
+    cluster = get_cluster(cluster_name, region)
+    
+    configuration = client.Configuration()
+    configuration.host = cluster['endpoint']
+    configuration.verify_ssl = True
+    configuration.ssl_ca_cert = write_ca_cert(cluster_name, region, cluster['certificateAuthority']['data'])
+    configuration.api_key = {"authorization": f"Bearer {get_bearer_token(cluster_name, region)}"}
+    
+    return client.ApiClient(configuration)
+
+def list_manifest_keys(bucket, prefix):
+    """List YAML manifest keys under a prefix, listing sub-prefixes in parallel.
+    
+    Pagination is sequential (each page needs the previous continuation token),
+    so one delimited LIST discovers the immediate sub-prefixes and each of them
+    is then paginated concurrently.
+    """
+    s3 = get_aws_client('s3')
+    paginator = s3.get_paginator('list_objects_v2')
+    
+    keys = []
+    sub_prefixes = []
+    for page in paginator.paginate(
+        Bucket=bucket,
+        Prefix=prefix,
+        Delimiter='/',
+        PaginationConfig={'PageSize': LIST_PAGE_SIZE}
+    ):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        sub_prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+    
+    def list_prefix(sub_prefix):
+        pages = s3.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket,
+            Prefix=sub_prefix,
+            PaginationConfig={'PageSize': LIST_PAGE_SIZE}
+        )
+        return [obj['Key'] for page in pages for obj in page.get('Contents', [])]
+    
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        for sub_keys in executor.map(list_prefix, sub_prefixes):
+            keys.extend(sub_keys)
+    
+    return sorted(key for key in keys if key.endswith(MANIFEST_SUFFIXES))
+
+def download_bundle(bucket, prefix):
+    """Download and parse the manifest bundle, or return None if there is none.
+    
+    Returns (file, documents) pairs in archive order.
+    """
+    s3 = get_aws_client('s3')
+    key = prefix + MANIFEST_BUNDLE
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None
+    
+    print(f"Downloading bundle {key}; individual manifests under {prefix} are ignored")
+    
+    # Stream the archive and parse each member as it is read; nothing is
+    # extracted to disk and only one member is buffered at a time
+    documents = []
+    with tarfile.open(fileobj=response['Body'], mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(MANIFEST_SUFFIXES):
+                continue
+            docs = yaml.load_all(tar.extractfile(member), Loader=SafeLoader)
+            documents.append((member.name, [doc for doc in docs if doc]))
+    
+    return documents
+
+def api_error_message(e):
+    """Return the API server's message for a failed request, or the HTTP reason."""
+    try:
+        return json.loads(e.body)['message']
+    except (TypeError, ValueError, KeyError):
+        return e.reason
+
+def apply_manifest(dyn_client, manifest_file, manifest):
+    """Server-side apply a single Kubernetes manifest."""
+    from kubernetes.client.rest import ApiException
+    
+    kind = manifest.get('kind')
+    metadata = manifest.get('metadata', {})
+    name = metadata.get('name')
+    namespace = metadata.get('namespace', 'default')
+    
+    print(f"Applying {kind}/{name} from {manifest_file}")
+    
+    try:
+        resource = dyn_client.resources.get(api_version=manifest.get('apiVersion'), kind=kind)
+        dyn_client.server_side_apply(
+            resource,
+            body=manifest,
+            name=name,
+            namespace=namespace,
+            field_manager=FIELD_MANAGER,
+            force_conflicts=True
+        )
+        return {'status': 'success'}
+    except ApiException as e:
+        print(f"✗ {kind}/{name}: {e}")
+        return {'status': 'failed', 'error': f'{kind}/{name}: {api_error_message(e)}'}
+    except Exception as e:
+        print(f"✗ {kind}/{name}: {e}")
+        return {'status': 'failed', 'error': f'{kind}/{name}: {e}'}
 
 def apply_manifests(event):
     """Apply Kubernetes manifests from S3."""
@@ -58,55 +267,46 @@ def apply_manifests(event):
     
     print(f"Applying manifests from s3://{bucket}/{prefix} to cluster {cluster_name}")
     
-    with tempfile.TemporaryDirectory() as tmpdir:
-        # Write kubeconfig
-        kubeconfig_path = os.path.join(tmpdir, 'kubeconfig')
-        with open(kubeconfig_path, 'w') as f:
-            f.write(get_kubeconfig(cluster_name, region))
-        
-        # Download manifests
-        paginator = s3.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
+    # Prefer the bundle; otherwise download the individual manifests, keeping
+    # the apply order stable across deploys
+    documents = download_bundle(bucket, prefix)
+    if documents is None:
+        s3 = get_aws_client('s3')
+        keys = list_manifest_keys(bucket, prefix)
+        keys.sort(key=os.path.basename)
         
-        manifest_files = []
-        for page in pages:
-            if 'Contents' not in page:
-                continue
-            for obj in page['Contents']:
-                key = obj['Key']
-                if key.endswith('.yaml') or key.endswith('.yml'):
-                    local_path = os.path.join(tmpdir, os.path.basename(key))
-                    print(f"Downloading {key}")
-                    s3.download_file(bucket, key, local_path)
-                    manifest_files.append(local_path)
+        def download(key):
+            print(f"Downloading {key}")
+            response = s3.get_object(Bucket=bucket, Key=key)
+            return [doc for doc in yaml.load_all(response['Body'], Loader=SafeLoader) if doc]
         
-        if not manifest_files:
-            return {'Message': 'No manifests found'}
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            documents = list(zip(keys, executor.map(download, keys)))
+    
+    if not documents:
+        return {'Message': 'No manifests found'}
+    
+    from kubernetes import dynamic
+    
+    # One ApiClient (and its keep-alive connection pool) serves every apply
+    with get_k8s_client(cluster_name, region) as api_client:
+        dyn_client = dynamic.DynamicClient(api_client)
         
-        # Apply manifests
         results = []
-        for manifest in sorted(manifest_files):
-            print(f"Applying {manifest}")
-            result = subprocess.run(
-                ['/opt/bin/kubectl', 'apply', '-f', manifest],
-                env={'KUBECONFIG': kubeconfig_path},
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
-            
-            if result.returncode == 0:
-                print(f"✓ {manifest}")
-                results.append({'file': os.path.basename(manifest), 'status': 'success'})
+        for key, docs in documents:
+            failed = [r for r in (apply_manifest(dyn_client, key, doc) for doc in docs) if r['status'] != 'success']
+            if failed:
+                error = '\n'.join(r['error'] for r in failed)
+                results.append({'file': os.path.basename(key), 'status': 'failed', 'error': error})
             else:
-                print(f"✗ {manifest}: {result.stderr}")
-                results.append({'file': os.path.basename(manifest), 'status': 'failed', 'error': result.stderr})
-        
-        return {'Results': results}
+                print(f"✓ {key}")
+                results.append({'file': os.path.basename(key), 'status': 'success'})
+    
+    return {'Results': results}
 
 def send_response(event, context, status, data):
     """Send response to CloudFormation."""
-    response_body = json.dumps({
+    response_body = to_json_bytes({
         'Status': status,
         'Reason': f'See CloudWatch Log Stream: {context.log_stream_name}',
         'PhysicalResourceId': context.log_stream_name,
@@ -117,11 +317,14 @@ def send_response(event, context, status, data):
     })
     
     headers = {'Content-Type': 'application/json'}
-    req = Request(event['ResponseURL'], data=response_body.encode('utf-8'), headers=headers, method='PUT')
     
     try:
-        urlopen(req)
-        print('Response sent successfully')
+        response = _HTTP.request('PUT', event['ResponseURL'], body=response_body, headers=headers)
+        # urllib3 doesn't raise on HTTP errors the way urlopen did
+        if response.status >= 400:
+            print(f'Error sending response: HTTP {response.status}')
+        else:
+            print('Response sent successfully')
     except Exception as e:
         print(f'Error sending response: {e}')
 
@@ -136,7 +339,7 @@ def handler(event, context):
             result = apply_manifests(event)
             send_response(event, context, 'SUCCESS', result)
         elif request_type == 'Delete':
-            # Don't delete manifests on stack deletion
+            # Don't delete manifests on stack deletion; no AWS or Kubernetes client is needed
             send_response(event, context, 'SUCCESS', {'Message': 'Skipped deletion'})
         else:
             send_response(event, context, 'FAILED', {'Message': f'Unknown request type: {request_type}'})
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+S3 and EKS helpers shared by the manifest applier handlers.
+
+Environment Variables:
+- CLUSTER_NAME: EKS cluster name
+- S3_BUCKET: S3 bucket containing manifests
+- S3_PREFIX: Prefix/folder in S3 bucket (e.g., "k8s/jenkins/")
+"""
+
+import os
+import json
+import base64
+import time
+import boto3
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.signers import RequestSigner
+
+# orjson encodes several times faster than json; fall back when it isn't bundled
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def to_json(obj):
+    """Serialize obj to a JSON string."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj)
+
+# Threads listing S3 sub-prefixes and downloading manifest files
+LIST_WORKERS = 16
+DOWNLOAD_WORKERS = 16
+
+# S3 can't filter by suffix, so keys are matched client-side; ask for full pages
+MANIFEST_SUFFIXES = ('.yaml', '.yml')
+LIST_PAGE_SIZE = 1000
+
+# Optional single-object bundle of every manifest under the prefix, which
+# replaces one LIST plus a GET per file with a single GET
+MANIFEST_BUNDLE = 'manifests.tar.gz'
+
+session = boto3.session.Session()
+# Room for one connection per list and download worker, so they never queue
+# on botocore's HTTPS pool (default 10)
+s3_client = boto3.client('s3', config=Config(max_pool_connections=LIST_WORKERS + DOWNLOAD_WORKERS))
+eks_client = boto3.client('eks')
+sts_client = boto3.client('sts')
+
+CLUSTER_NAME = os.environ['CLUSTER_NAME']
+S3_BUCKET = os.environ['S3_BUCKET']
+S3_PREFIX = os.environ.get('S3_PREFIX', 'k8s/jenkins/')
+
+# Cached across warm invocations: the cluster endpoint and CA never change,
+# and EKS tokens stay valid for 15 minutes so refresh well before that
+TOKEN_TTL_SECONDS = 600
+_CLUSTER_CACHE = None
+_TOKEN_CACHE = (None, 0)
+_CA_CERT_PATH = None
+
+def get_cluster():
+    """Describe the EKS cluster, once per Lambda container."""
+    global _CLUSTER_CACHE
+    if _CLUSTER_CACHE is None:
+        _CLUSTER_CACHE = eks_client.describe_cluster(name=CLUSTER_NAME)['cluster']
+    return _CLUSTER_CACHE
+
+def write_ca_cert(ca_data):
+    """Write CA certificate to /tmp, once per Lambda container."""
+    global _CA_CERT_PATH
+    if _CA_CERT_PATH is None:
+        path = os.path.join(tempfile.gettempdir(), f'{CLUSTER_NAME}-ca.crt')
+        with open(path, 'wb') as f:
+            f.write(base64.b64decode(ca_data))
+        _CA_CERT_PATH = path
+    return _CA_CERT_PATH
+
+# Pay the S3 and EKS TLS handshakes during Lambda init instead of the first
+# invocation; describe_cluster also primes the cluster cache and CA file
+try:
+    s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=S3_PREFIX, MaxKeys=1)
+    write_ca_cert(get_cluster()['certificateAuthority']['data'])
+except Exception as e:
+    print(f"Warning: pre-warm failed: {e}")
+
+def get_bearer_token():
+    """Get EKS authentication token, reusing it while still fresh.
+    
+    Builds the same token as 'aws eks get-token': a presigned STS
+    GetCallerIdentity URL bound to the cluster by the x-k8s-aws-id header.
+    """
+    global _TOKEN_CACHE
+    token, fetched_at = _TOKEN_CACHE
+    if token and time.monotonic() - fetched_at < TOKEN_TTL_SECONDS:
+        return token
+    
+    region = sts_client.meta.region_name
+    signer = RequestSigner(
+        sts_client.meta.service_model.service_id,
+        region,
+        'sts',
+        'v4',
+        session.get_credentials(),
+        session.events
+    )
+    url = signer.generate_presigned_url(
+        {
+            'method': 'GET',
+            'url': f"{sts_client.meta.endpoint_url.rstrip('/')}/?Action=GetCallerIdentity&Version=2011-06-15",
+            'body': {},
+            'headers': {'x-k8s-aws-id': CLUSTER_NAME},
+            'context': {}
+        },
+        region_name=region,
+        expires_in=60,
+        operation_name=''
+    )
+    token = 'k8s-aws-v1.' + base64.urlsafe_b64encode(url.encode('utf-8')).decode('utf-8').rstrip('=')
+    _TOKEN_CACHE = (token, time.monotonic())
+    return token
+
+def list_manifest_keys(bucket, prefix):
+    """List YAML manifest keys under a prefix, listing sub-prefixes in parallel.
+    
+    Pagination is sequential (each page needs the previous continuation token),
+    so one delimited LIST discovers the immediate sub-prefixes and each of them
+    is then paginated concurrently.
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    
+    keys = []
+    sub_prefixes = []
+    for page in paginator.paginate(
+        Bucket=bucket,
+        Prefix=prefix,
+        Delimiter='/',
+        PaginationConfig={'PageSize': LIST_PAGE_SIZE}
+    ):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        sub_prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+    
+    def list_prefix(sub_prefix):
+        pages = s3_client.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket,
+            Prefix=sub_prefix,
+            PaginationConfig={'PageSize': LIST_PAGE_SIZE}
+        )
+        return [obj['Key'] for page in pages for obj in page.get('Contents', [])]
+    
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        for sub_keys in executor.map(list_prefix, sub_prefixes):
+            keys.extend(sub_keys)
+    
+    return sorted(key for key in keys if key.endswith(MANIFEST_SUFFIXES))
+
+def open_bundle():
+    """Open the manifest bundle for streaming, or return None if there is none."""
+    key = S3_PREFIX + MANIFEST_BUNDLE
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    
+    print(f"Downloading bundle {key}; individual manifests under {S3_PREFIX} are ignored")
+    return response['Body']
+
+def iter_bundle(body):
+    """Yield (name, file object) for each YAML member of a streamed bundle.
+    
+    The archive is read front to back without touching disk, so each file
+    object must be consumed before the next member is requested.
+    """
+    with tarfile.open(fileobj=body, mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith(MANIFEST_SUFFIXES):
+                continue
+            yield member.name, tar.extractfile(member)
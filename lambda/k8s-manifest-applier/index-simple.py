@@ -7,35 +7,50 @@ Environment Variables:
 - CLUSTER_NAME: EKS cluster name
 - S3_BUCKET: S3 bucket containing manifests
 - S3_PREFIX: Prefix/folder in S3 bucket
+- APPLY_WORKERS: Number of manifests applied concurrently (default: 8)
 """
 
 import os
 import json
-import boto3
-import base64
+import threading
 import yaml
-from kubernetes import client, config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from kubernetes import client, config, dynamic
 from kubernetes.client.rest import ApiException
 
-s3_client = boto3.client('s3')
-eks_client = boto3.client('eks')
-sts_client = boto3.client('sts')
+from common import (
+    DOWNLOAD_WORKERS,
+    S3_BUCKET,
+    S3_PREFIX,
+    get_bearer_token,
+    get_cluster,
+    iter_bundle,
+    list_manifest_keys,
+    open_bundle,
+    s3_client,
+    to_json,
+    write_ca_cert,
+)
 
-CLUSTER_NAME = os.environ['CLUSTER_NAME']
-S3_BUCKET = os.environ['S3_BUCKET']
-S3_PREFIX = os.environ.get('S3_PREFIX', 'k8s/jenkins/')
+# Prefer the libyaml-backed loader, which parses several times faster
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+APPLY_WORKERS = int(os.environ.get('APPLY_WORKERS', '8'))
+
+FIELD_MANAGER = 'jenkins-applier'
+
+# The dynamic client's discoverer caches API resources (in memory and under
+# /tmp) as it resolves them; that cache is shared by the apply workers and
+# isn't thread-safe, hence the lock
+_DISCOVERY_LOCK = threading.Lock()
 
 def get_k8s_client():
     """Create Kubernetes client configured for EKS cluster."""
     # Get cluster info
-    cluster_info = eks_client.describe_cluster(name=CLUSTER_NAME)
-    cluster = cluster_info['cluster']
-    
-    # Get authentication token
-    token_response = sts_client.assume_role(
-        RoleArn=os.environ['EXECUTION_ROLE_ARN'],
-        RoleSessionName='k8s-manifest-applier'
-    )
+    cluster = get_cluster()
     
     # Configure Kubernetes client
     configuration = client.Configuration()
@@ -43,55 +58,67 @@ def get_k8s_client():
     configuration.verify_ssl = True
     configuration.ssl_ca_cert = write_ca_cert(cluster['certificateAuthority']['data'])
     configuration.api_key = {"authorization": f"Bearer {get_bearer_token()}"}
+    # The ApiClient is shared by the apply workers; urllib3's pool is thread-safe
+    # but must be large enough to keep one connection per worker alive
+    configuration.connection_pool_maxsize = APPLY_WORKERS
     
     return client.ApiClient(configuration)
 
-def write_ca_cert(ca_data):
-    """Write CA certificate to temp file."""
-    import tempfile
-    ca_cert = base64.b64decode(ca_data)
-    with tempfile.NamedTemporaryFile(delete=False, mode='w') as f:
-        f.write(ca_cert.decode('utf-8'))
-        return f.name
-
-def get_bearer_token():
-    """Get EKS authentication token."""
-    import subprocess
-    result = subprocess.run(
-        ['aws', 'eks', 'get-token', '--cluster-name', CLUSTER_NAME],
-        capture_output=True,
-        text=True
-    )
-    token_data = json.loads(result.stdout)
-    return token_data['status']['token']
+def download_bundle():
+    """Download and parse the manifest bundle, or return None if there is none."""
+    body = open_bundle()
+    if body is None:
+        return None
+    
+    # Parse each member as it is streamed; only one is buffered at a time.
+    # Members are reported by their S3 key, as if downloaded one by one
+    manifests = []
+    for name, member in iter_bundle(body):
+        docs = list(yaml.load_all(member, Loader=SafeLoader))
+        manifests.extend([(S3_PREFIX + name, doc) for doc in docs if doc])
+    
+    return manifests
 
 def download_manifests():
-    """Download all YAML manifests from S3."""
+    """Download all YAML manifests from S3, yielding (key, document) pairs.
+    
+    Files are fetched by a thread pool and yielded in completion order, so
+    the caller can start applying before the last download finishes and a
+    slow GET doesn't hold back the files behind it.
+    """
     print(f"Downloading manifests from s3://{S3_BUCKET}/{S3_PREFIX}")
     
-    paginator = s3_client.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=S3_PREFIX)
+    manifests = download_bundle()
+    if manifests is not None:
+        yield from manifests
+        return
     
-    manifests = []
-    for page in pages:
-        if 'Contents' not in page:
-            continue
-            
-        for obj in page['Contents']:
-            key = obj['Key']
-            if key.endswith('.yaml') or key.endswith('.yml'):
-                print(f"Downloading {key}")
-                response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
-                content = response['Body'].read().decode('utf-8')
-                
-                # Parse YAML (may contain multiple documents)
-                docs = list(yaml.safe_load_all(content))
-                manifests.extend([(key, doc) for doc in docs if doc])
+    keys = list_manifest_keys(S3_BUCKET, S3_PREFIX)
     
-    return manifests
+    def download(key):
+        print(f"Downloading {key}")
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+        
+        # Parse YAML (may contain multiple documents) straight from the response
+        # stream so the raw bytes and a decoded copy are never held in memory
+        docs = list(yaml.load_all(response['Body'], Loader=SafeLoader))
+        return [(key, doc) for doc in docs if doc]
+    
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(download, key) for key in keys]
+        for future in as_completed(futures):
+            yield from future.result()
 
-def apply_manifest(k8s_client, manifest_file, manifest):
-    """Apply a single Kubernetes manifest."""
+def get_resource(dyn_client, api_version, kind):
+    """Look up the API resource serving a kind."""
+    with _DISCOVERY_LOCK:
+        return dyn_client.resources.get(api_version=api_version, kind=kind)
+
+def apply_manifest(dyn_client, manifest_file, manifest):
+    """Server-side apply a single Kubernetes manifest.
+    
+    One idempotent PATCH creates or updates the object, whatever its kind.
+    """
     kind = manifest.get('kind')
     api_version = manifest.get('apiVersion')
     metadata = manifest.get('metadata', {})
@@ -101,45 +128,15 @@ def apply_manifest(k8s_client, manifest_file, manifest):
     print(f"Applying {kind}/{name} in namespace {namespace}")
     
     try:
-        # Determine which API to use based on kind
-        if kind == 'Namespace':
-            api = client.CoreV1Api(k8s_client)
-            api.create_namespace(body=manifest)
-        elif kind == 'ConfigMap':
-            api = client.CoreV1Api(k8s_client)
-            try:
-                api.read_namespaced_config_map(name, namespace)
-                api.replace_namespaced_config_map(name, namespace, body=manifest)
-            except ApiException as e:
-                if e.status == 404:
-                    api.create_namespaced_config_map(namespace, body=manifest)
-                else:
-                    raise
-        elif kind == 'ServiceAccount':
-            api = client.CoreV1Api(k8s_client)
-            try:
-                api.read_namespaced_service_account(name, namespace)
-                api.replace_namespaced_service_account(name, namespace, body=manifest)
-            except ApiException as e:
-                if e.status == 404:
-                    api.create_namespaced_service_account(namespace, body=manifest)
-                else:
-                    raise
-        elif kind == 'StatefulSet':
-            api = client.AppsV1Api(k8s_client)
-            try:
-                api.read_namespaced_stateful_set(name, namespace)
-                api.replace_namespaced_stateful_set(name, namespace, body=manifest)
-            except ApiException as e:
-                if e.status == 404:
-                    api.create_namespaced_stateful_set(namespace, body=manifest)
-                else:
-                    raise
-        # Add more resource types as needed
-        else:
-            print(f"Warning: Unsupported kind {kind}, skipping")
-            return {'status': 'skipped', 'reason': f'Unsupported kind: {kind}'}
-        
+        resource = get_resource(dyn_client, api_version, kind)
+        dyn_client.server_side_apply(
+            resource,
+            body=manifest,
+            name=name,
+            namespace=namespace,
+            field_manager=FIELD_MANAGER,
+            force_conflicts=True
+        )
         return {'status': 'success'}
     
     except ApiException as e:
@@ -149,6 +146,61 @@ def apply_manifest(k8s_client, manifest_file, manifest):
         print(f"Unexpected error applying {kind}/{name}: {e}")
         return {'status': 'error', 'error': str(e)}
 
+def apply_manifests(k8s_client, manifests):
+    """Apply manifests as they arrive, Namespaces before what they contain.
+    
+    Namespace manifests are applied serially as soon as they are seen; other
+    manifests go to a worker pool. A manifest whose namespace hasn't been
+    applied yet waits until it is, or until the stream ends, since it may be
+    defined by a file still downloading.
+    """
+    dyn_client = dynamic.DynamicClient(k8s_client)
+    applied_namespaces = {'default'}
+    stream_done = False
+    namespaces_changed = threading.Condition()
+    
+    def apply(manifest_file, manifest):
+        result = apply_manifest(dyn_client, manifest_file, manifest)
+        return {
+            'file': manifest_file,
+            'kind': manifest.get('kind'),
+            'name': manifest.get('metadata', {}).get('name'),
+            **result
+        }
+    
+    def apply_when_ready(manifest_file, manifest):
+        namespace = manifest.get('metadata', {}).get('namespace', 'default')
+        with namespaces_changed:
+            namespaces_changed.wait_for(lambda: stream_done or namespace in applied_namespaces)
+        return apply(manifest_file, manifest)
+    
+    results = []
+    futures = []
+    with ThreadPoolExecutor(max_workers=APPLY_WORKERS) as executor:
+        try:
+            for manifest_file, manifest in manifests:
+                if manifest.get('kind') == 'Namespace':
+                    result = apply(manifest_file, manifest)
+                    if result['status'] == 'success':
+                        with namespaces_changed:
+                            applied_namespaces.add(result['name'])
+                            namespaces_changed.notify_all()
+                    results.append(result)
+                else:
+                    futures.append(executor.submit(apply_when_ready, manifest_file, manifest))
+        finally:
+            # Release waiting workers even if a download failed
+            with namespaces_changed:
+                stream_done = True
+                namespaces_changed.notify_all()
+        
+        results.extend(future.result() for future in futures)
+    
+    # Files arrive in completion order; report them in key order. The sort is
+    # stable, so documents keep their order within a file
+    results.sort(key=lambda result: result['file'])
+    return results
+
 def lambda_handler(event, context):
     """Lambda handler function."""
     print(f"Event: {json.dumps(event)}")
@@ -157,31 +209,21 @@ def lambda_handler(event, context):
         # Get Kubernetes client
         k8s_client = get_k8s_client()
         
-        # Download manifests from S3
-        manifests = download_manifests()
+        # Download, parse and apply overlap: manifests are applied as their
+        # files arrive from S3
+        results = apply_manifests(k8s_client, download_manifests())
         
-        if not manifests:
+        if not results:
             return {
                 'statusCode': 200,
-                'body': json.dumps({
+                'body': to_json({
                     'message': 'No manifest files found in S3',
                     'bucket': S3_BUCKET,
                     'prefix': S3_PREFIX
                 })
             }
         
-        print(f"Found {len(manifests)} manifest(s)")
-        
-        # Apply manifests
-        results = []
-        for manifest_file, manifest in manifests:
-            result = apply_manifest(k8s_client, manifest_file, manifest)
-            results.append({
-                'file': manifest_file,
-                'kind': manifest.get('kind'),
-                'name': manifest.get('metadata', {}).get('name'),
-                **result
-            })
+        print(f"Applied {len(results)} manifest(s)")
         
         # Check if any failed
         failed = [r for r in results if r['status'] in ['failed', 'error']]
@@ -189,7 +231,7 @@ def lambda_handler(event, context):
         if failed:
             return {
                 'statusCode': 500,
-                'body': json.dumps({
+                'body': to_json({
                     'message': f'{len(failed)} manifest(s) failed to apply',
                     'results': results
                 })
@@ -197,7 +239,7 @@ def lambda_handler(event, context):
         
         return {
             'statusCode': 200,
-            'body': json.dumps({
+            'body': to_json({
                 'message': f'Successfully applied {len(results)} manifest(s)',
                 'results': results
             })
@@ -210,7 +252,7 @@ def lambda_handler(event, context):
         
         return {
             'statusCode': 500,
-            'body': json.dumps({
+            'body': to_json({
                 'message': 'Error applying manifests',
                 'error': str(e)
             })
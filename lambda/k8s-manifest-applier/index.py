@@ -15,156 +15,169 @@ Environment Variables:
 
 import os
 import json
-import boto3
+import shutil
 import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-s3 = boto3.client('s3')
-eks = boto3.client('eks')
+from common import (
+    DOWNLOAD_WORKERS,
+    S3_BUCKET,
+    S3_PREFIX,
+    get_bearer_token,
+    get_cluster,
+    iter_bundle,
+    list_manifest_keys,
+    open_bundle,
+    s3_client,
+    to_json,
+    write_ca_cert,
+)
 
-CLUSTER_NAME = os.environ['CLUSTER_NAME']
-S3_BUCKET = os.environ['S3_BUCKET']
-S3_PREFIX = os.environ.get('S3_PREFIX', 'k8s/jenkins/')
+# kubectl's discovery and HTTP caches default to $HOME/.kube/cache, which isn't
+# writable in Lambda; /tmp survives warm invocations so discovery is fetched once
+KUBECTL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'kube-cache')
+KUBECTL_ENV = {'HOME': tempfile.gettempdir(), 'PATH': '/opt/bin:/usr/local/bin:/usr/bin:/bin'}
 
-def get_kubeconfig():
-    """Generate kubeconfig for EKS cluster."""
-    cluster_info = eks.describe_cluster(name=CLUSTER_NAME)
-    cluster = cluster_info['cluster']
-    
-    kubeconfig = {
-        'apiVersion': 'v1',
-        'kind': 'Config',
-        'clusters': [{
-            'name': CLUSTER_NAME,
-            'cluster': {
-                'server': cluster['endpoint'],
-                'certificate-authority-data': cluster['certificateAuthority']['data']
-            }
-        }],
-        'contexts': [{
-            'name': CLUSTER_NAME,
-            'context': {
-                'cluster': CLUSTER_NAME,
-                'user': CLUSTER_NAME
-            }
-        }],
-        'current-context': CLUSTER_NAME,
-        'users': [{
-            'name': CLUSTER_NAME,
-            'user': {
-                'exec': {
-                    'apiVersion': 'client.authentication.k8s.io/v1beta1',
-                    'command': 'aws',
-                    'args': [
-                        'eks',
-                        'get-token',
-                        '--cluster-name',
-                        CLUSTER_NAME,
-                        '--region',
-                        os.environ['AWS_REGION']
-                    ]
-                }
-            }
-        }]
-    }
+# kubectl is given whatever invocation time is left, minus enough to report a
+# timeout before Lambda kills the function
+APPLY_TIMEOUT_MARGIN_SECONDS = 15
+
+def get_connection_args():
+    """Build kubectl flags that connect to the EKS cluster without a kubeconfig."""
+    cluster = get_cluster()
     
-    return kubeconfig
+    return [
+        '--server', cluster['endpoint'],
+        '--certificate-authority', write_ca_cert(cluster['certificateAuthority']['data']),
+        '--token', get_bearer_token()
+    ]
+
+def download_bundle(temp_dir):
+    """Unpack the manifest bundle into temp_dir, or return None if there is none."""
+    body = open_bundle()
+    if body is None:
+        return None
+    
+    # Write YAML members flat into temp_dir by basename (as the per-file
+    # download does) so member paths can't escape it
+    manifest_files = []
+    for name, member in iter_bundle(body):
+        local_path = os.path.join(temp_dir, os.path.basename(name))
+        with open(local_path, 'wb') as f:
+            shutil.copyfileobj(member, f)
+        manifest_files.append(local_path)
+    
+    return manifest_files
 
 def download_manifests(temp_dir):
     """Download all YAML manifests from S3."""
     print(f"Downloading manifests from s3://{S3_BUCKET}/{S3_PREFIX}")
     
-    paginator = s3.get_paginator('list_objects_v2')
-    pages = paginator.paginate(Bucket=S3_BUCKET, Prefix=S3_PREFIX)
+    manifest_files = download_bundle(temp_dir)
+    if manifest_files is not None:
+        return manifest_files
     
-    manifest_files = []
-    for page in pages:
-        if 'Contents' not in page:
-            continue
-            
-        for obj in page['Contents']:
-            key = obj['Key']
-            if key.endswith('.yaml') or key.endswith('.yml'):
-                # Download file
-                local_path = os.path.join(temp_dir, os.path.basename(key))
-                print(f"Downloading {key} to {local_path}")
-                s3.download_file(S3_BUCKET, key, local_path)
-                manifest_files.append(local_path)
+    keys = list_manifest_keys(S3_BUCKET, S3_PREFIX)
+    
+    def download(key):
+        local_path = os.path.join(temp_dir, os.path.basename(key))
+        print(f"Downloading {key} to {local_path}")
+        s3_client.download_file(S3_BUCKET, key, local_path)
+        return local_path
+    
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        manifest_files = list(executor.map(download, keys))
     
     return manifest_files
 
-def apply_manifests(kubeconfig_path, manifest_files):
-    """Apply Kubernetes manifests using kubectl."""
-    results = []
+def split_batch_result(manifest_files, result):
+    """Rebuild per-file results from a single batched kubectl apply.
     
-    for manifest_file in sorted(manifest_files):
-        print(f"Applying {manifest_file}")
-        
-        try:
-            result = subprocess.run(
-                ['kubectl', 'apply', '-f', manifest_file],
-                env={'KUBECONFIG': kubeconfig_path},
-                capture_output=True,
-                text=True,
-                timeout=60
-            )
-            
-            if result.returncode == 0:
-                print(f"✓ Successfully applied {manifest_file}")
-                print(result.stdout)
-                results.append({
-                    'file': os.path.basename(manifest_file),
-                    'status': 'success',
-                    'output': result.stdout
-                })
-            else:
-                print(f"✗ Failed to apply {manifest_file}")
-                print(result.stderr)
-                results.append({
-                    'file': os.path.basename(manifest_file),
-                    'status': 'failed',
-                    'error': result.stderr
-                })
-        except subprocess.TimeoutExpired:
-            print(f"✗ Timeout applying {manifest_file}")
-            results.append({
-                'file': os.path.basename(manifest_file),
-                'status': 'timeout',
-                'error': 'Command timed out after 60 seconds'
-            })
-        except Exception as e:
-            print(f"✗ Error applying {manifest_file}: {str(e)}")
-            results.append({
-                'file': os.path.basename(manifest_file),
-                'status': 'error',
-                'error': str(e)
-            })
+    kubectl names the offending file in every error line (quoted for API
+    errors, bare for parse errors), so failures are attributed to those
+    files. A batch that fails without naming any file (e.g. authentication)
+    reports the whole stderr against every file. A successful batch is
+    never split, so warnings that name a file can't fail it.
+    """
+    if result.returncode == 0:
+        errors = {manifest: [] for manifest in manifest_files}
+    else:
+        # Paths are absolute and filtered by suffix, so one can't match another
+        errors = {
+            manifest: [line for line in result.stderr.splitlines() if manifest in line]
+            for manifest in manifest_files
+        }
+    blame_all = result.returncode != 0 and not any(errors.values())
     
+    results = []
+    for manifest in manifest_files:
+        if blame_all:
+            results.append({'file': os.path.basename(manifest), 'status': 'failed', 'error': result.stderr})
+        elif errors[manifest]:
+            results.append({'file': os.path.basename(manifest), 'status': 'failed', 'error': '\n'.join(errors[manifest])})
+        else:
+            results.append({'file': os.path.basename(manifest), 'status': 'success'})
     return results
 
+def apply_manifests(manifest_files, context):
+    """Apply Kubernetes manifests using a single batched kubectl invocation."""
+    manifest_files = sorted(manifest_files)
+    args = ['kubectl', 'apply', '--cache-dir', KUBECTL_CACHE_DIR] + get_connection_args()
+    for manifest_file in manifest_files:
+        args.extend(['-f', manifest_file])
+    timeout = max(1, context.get_remaining_time_in_millis() // 1000 - APPLY_TIMEOUT_MARGIN_SECONDS)
+    
+    print(f"Applying {len(manifest_files)} manifest file(s)")
+    
+    try:
+        os.makedirs(KUBECTL_CACHE_DIR, exist_ok=True)
+        result = subprocess.run(
+            args,
+            env=KUBECTL_ENV,
+            capture_output=True,
+            text=True,
+            timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        print("✗ Timeout applying manifests")
+        return [{
+            'file': os.path.basename(manifest_file),
+            'status': 'timeout',
+            'error': f'Command timed out after {timeout} seconds'
+        } for manifest_file in manifest_files]
+    except Exception as e:
+        print(f"✗ Error applying manifests: {str(e)}")
+        return [{
+            'file': os.path.basename(manifest_file),
+            'status': 'error',
+            'error': str(e)
+        } for manifest_file in manifest_files]
+    
+    print(result.stdout)
+    if result.returncode == 0:
+        print(f"✓ Successfully applied {len(manifest_files)} manifest file(s)")
+    else:
+        print("✗ Failed to apply manifests")
+        print(result.stderr)
+    
+    return split_batch_result(manifest_files, result)
+
 def lambda_handler(event, context):
     """Lambda handler function."""
     print(f"Event: {json.dumps(event)}")
     
     try:
-        # Create temporary directory for manifests and kubeconfig
+        # Create temporary directory for manifests
         with tempfile.TemporaryDirectory() as temp_dir:
-            # Generate kubeconfig
-            kubeconfig = get_kubeconfig()
-            kubeconfig_path = os.path.join(temp_dir, 'kubeconfig')
-            with open(kubeconfig_path, 'w') as f:
-                json.dump(kubeconfig, f)
-            
-            print(f"Kubeconfig written to {kubeconfig_path}")
-            
             # Download manifests from S3
             manifest_files = download_manifests(temp_dir)
             
             if not manifest_files:
                 return {
                     'statusCode': 200,
-                    'body': json.dumps({
+                    'body': to_json({
                         'message': 'No manifest files found in S3',
                         'bucket': S3_BUCKET,
                         'prefix': S3_PREFIX
@@ -174,7 +187,7 @@ def lambda_handler(event, context):
             print(f"Found {len(manifest_files)} manifest files")
             
             # Apply manifests
-            results = apply_manifests(kubeconfig_path, manifest_files)
+            results = apply_manifests(manifest_files, context)
             
             # Check if any failed
             failed = [r for r in results if r['status'] != 'success']
@@ -182,7 +195,7 @@ def lambda_handler(event, context):
             if failed:
                 return {
                     'statusCode': 500,
-                    'body': json.dumps({
+                    'body': to_json({
                         'message': f'{len(failed)} manifest(s) failed to apply',
                         'results': results
                     })
@@ -190,7 +203,7 @@ def lambda_handler(event, context):
             
             return {
                 'statusCode': 200,
-                'body': json.dumps({
+                'body': to_json({
                     'message': f'Successfully applied {len(results)} manifest(s)',
                     'results': results
                 })
@@ -203,7 +216,7 @@ def lambda_handler(event, context):
         
         return {
             'statusCode': 500,
-            'body': json.dumps({
+            'body': to_json({
                 'message': 'Error applying manifests',
                 'error': str(e)
             })
@@ -0,0 +1,46 @@
+#!/bin/bash
+# Script to bundle Kubernetes manifests into a single S3 object
+#
+# When <prefix>manifests.tar.gz exists, the manifest applier Lambdas fetch it
+# with one GET instead of listing the prefix and downloading every file.
+# Re-run this whenever the manifests change, or delete the bundle to fall
+# back to the individual files.
+#
+# Usage: ./package-manifests.sh <bucket> [s3-prefix] [manifest-dir]
+# manifest-dir defaults to the repository's k8s/jenkins, wherever this is run from
+
+set -e
+
+BUCKET="$1"
+PREFIX="${2:-k8s/jenkins/}"
+REPO_ROOT="$(cd "$(dirname "$0")/../.." && pwd)"
+MANIFEST_DIR="${3:-${REPO_ROOT}/k8s/jenkins}"
+
+if [ -z "$BUCKET" ]; then
+  echo "Usage: $0 <bucket> [s3-prefix] [manifest-dir]"
+  exit 1
+fi
+
+echo "Bundling manifests from ${MANIFEST_DIR}..."
+
+# Sorted so the bundle applies in the same order as the per-file fallback;
+# NUL-separated so file names with spaces survive (portable to BSD find/sort)
+FILES=()
+while IFS= read -r -d '' file; do
+  FILES+=("${file#./}")
+done < <(cd "$MANIFEST_DIR" && find . -maxdepth 1 -type f \( -name '*.yaml' -o -name '*.yml' \) -print0 | sort -z)
+
+if [ ${#FILES[@]} -eq 0 ]; then
+  echo "No manifests found in ${MANIFEST_DIR}"
+  exit 1
+fi
+
+tar -czf manifests.tar.gz -C "$MANIFEST_DIR" -- "${FILES[@]}"
+
+echo "Uploading to s3://${BUCKET}/${PREFIX}manifests.tar.gz..."
+aws s3 cp manifests.tar.gz "s3://${BUCKET}/${PREFIX}manifests.tar.gz"
+
+echo "✓ Bundled ${#FILES[@]} manifest file(s)"
+
+# Cleanup
+rm -f manifests.tar.gz
@@ -1,9 +1,27 @@
 #!/bin/bash
 # Script to build kubectl Lambda layer
+#
+# Usage: ./build-layer.sh [amd64|arm64]
+# Build for arm64 to run the Lambda on Graviton (Architecture.ARM_64), which
+# gives better price-performance for the Python/YAML work in the handlers.
 
 set -e
 
-echo "Building kubectl Lambda layer..."
+ARCH="${1:-${ARCH:-amd64}}"
+case "$ARCH" in
+  amd64|x86_64)
+    ARCH="amd64"
+    ;;
+  arm64|aarch64)
+    ARCH="arm64"
+    ;;
+  *)
+    echo "Unsupported architecture: $ARCH (expected amd64 or arm64)"
+    exit 1
+    ;;
+esac
+
+echo "Building kubectl Lambda layer for linux/${ARCH}..."
 
 # Create layer directory structure
 mkdir -p layer/bin
@@ -11,17 +29,11 @@ mkdir -p layer/bin
 # Download kubectl binary
 echo "Downloading kubectl..."
 KUBECTL_VERSION="v1.32.0"
-curl -LO "https://dl.k8s.io/release/${KUBECTL_VERSION}/bin/linux/amd64/kubectl"
+curl -LO "https://dl.k8s.io/release/${KUBECTL_VERSION}/bin/linux/${ARCH}/kubectl"
 chmod +x kubectl
 mv kubectl layer/bin/
 
-# Download AWS CLI (needed for EKS token)
-echo "Downloading AWS CLI..."
-curl "https://awscli.amazonaws.com/awscli-exe-linux-x86_64.zip" -o "awscliv2.zip"
-unzip -q awscliv2.zip
-./aws/install --install-dir layer/aws-cli --bin-dir layer/bin
-rm -rf aws awscliv2.zip
-
+# No AWS CLI: the handlers sign EKS tokens in-process and pass them to kubectl
 # Create zip file
 echo "Creating layer zip..."
 cd layer
@@ -29,6 +41,7 @@ zip -r ../kubectl-layer.zip . -q
 cd ..
 
 echo "✓ kubectl-layer.zip created successfully"
+echo "  Architecture: linux/${ARCH}"
 echo "  Size: $(du -h kubectl-layer.zip | cut -f1)"
 echo "  Location: $(pwd)/kubectl-layer.zip"
 
@@ -40,3 +53,4 @@ echo "To use this layer:"
 echo "1. Upload to S3 or use directly in CDK"
 echo "2. Attach to Lambda function"
 echo "3. Set PATH=/opt/bin:\$PATH in Lambda environment"
+echo "4. Match the function architecture to the layer (arm64 = lambda.Architecture.ARM_64)"